@@ -1,17 +1,27 @@
 # dnd_xp_bot.py
 import os
-import json
 import asyncio
+import atexit
+import hashlib
+import signal
+import time
+from bisect import bisect_right
 from typing import Dict, Any, Optional, Tuple, List
 
 import discord
+import orjson
 from discord import app_commands
 from discord.ext import commands
 
 # -------------------- Конфиг --------------------
 DATA_FILE = os.getenv("XP_DATA_FILE", "xp_data.json")
+COMMANDS_HASH_FILE = os.getenv("XP_COMMANDS_HASH_FILE", ".cmd_hash")
 MAX_MESSAGE_LEN = 1900
 PROGRESS_WIDTH = 20
+XP_LOG_FILE = DATA_FILE + ".log"
+MISSING_MEMBER_TTL = 300.0  # сек., сколько помним, что участника нет на сервере
+FLUSH_DELAY = 1.0           # сек. между изменением БД и дозаписью в лог
+SNAPSHOT_INTERVAL = 60.0    # сек. между полными снапшотами DATA_FILE
 
 # Цвета
 COLOR_PRIMARY = discord.Color.from_rgb(52, 152, 219)
@@ -44,72 +54,164 @@ XP_THRESHOLDS = [
     355000  # 20
 ]
 
+# Текст для /xptable, собирается один раз при импорте
+XPTABLE_TEXT = "```\n" + "\n".join(
+    ["Пороги XP (кумулятивно):"] + [f"{i:>2}: {threshold}" for i, threshold in enumerate(XP_THRESHOLDS, start=1)]
+) + "\n```"
+
 # -------------------- Хранилище --------------------
 db_lock = asyncio.Lock()
+# БД читается с диска один раз, дальше все команды работают с этим же dict
+DB_CACHE: Optional[Dict[str, Any]] = None
+
+def _migrate_db(db: Dict[str, Any]) -> Dict[str, Any]:
+    # Старый формат {uid: {"xp": N}} -> плоский {uid: N}
+    for g in db.values():
+        members = g.get("members", {})
+        for uid, m in members.items():
+            if isinstance(m, dict):
+                members[uid] = int(m.get("xp", 0))
+    return db
+
+def _replay_log(db: Dict[str, Any]) -> bool:
+    # Накатывает на снапшот изменения из лога; каждая строка — итоговый XP, поэтому повтор безопасен.
+    # Возвращает True, если лог не пустой (даже если в нём только оборванная запись)
+    if not os.path.exists(XP_LOG_FILE) or os.path.getsize(XP_LOG_FILE) == 0:
+        return False
+    with open(XP_LOG_FILE, "rb") as f:
+        for line in f:
+            try:
+                rec = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue  # оборванная запись после падения
+            db.setdefault(rec["g"], {"members": {}})["members"][rec["u"]] = rec["x"]
+    return True
 
 def load_db() -> Dict[str, Any]:
-    if not os.path.exists(DATA_FILE):
-        return {}
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    global DB_CACHE
+    if DB_CACHE is None:
+        if os.path.exists(DATA_FILE):
+            with open(DATA_FILE, "rb") as f:
+                db = _migrate_db(orjson.loads(f.read()))
+        else:
+            db = {}
+        if _replay_log(db):
+            # Сразу сворачиваем лог в снапшот: иначе новые записи допишутся
+            # вплотную к оборванному хвосту и тоже не прочитаются при следующем старте
+            save_db(db)
+            open(XP_LOG_FILE, "wb").close()
+        DB_CACHE = db
+    return DB_CACHE
 
 def save_db(db: Dict[str, Any]) -> None:
     tmp = DATA_FILE + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(db, f, ensure_ascii=False, indent=2)
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(db, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
     os.replace(tmp, DATA_FILE)
 
+# Команды пишут изменения в append-only лог (одна строка на участника),
+# весь DATA_FILE переписывается только при снапшоте, после чего лог обнуляется
+_pending_log: List[bytes] = []
+_log_dirty = False  # в XP_LOG_FILE есть записи, которых нет в снапшоте
+_log_torn = False   # прошлая дозапись упала и могла оставить оборванную строку
+_flush_event = asyncio.Event()
+_flush_task: Optional[asyncio.Task] = None
+_snapshot_task: Optional[asyncio.Task] = None
+
+def record_xp(guild_id: int, user_id: int, xp: int) -> None:
+    # Вызывать под db_lock, после изменения DB_CACHE
+    _pending_log.append(orjson.dumps({"g": str(guild_id), "u": str(user_id), "x": xp}) + b"\n")
+    _flush_event.set()
+
+def flush_log() -> None:
+    global _log_dirty, _log_torn
+    if not _pending_log:
+        return
+    # Флаг ставим до записи: если дозапись упадёт, снапшот всё равно сохранит кэш
+    _log_dirty = True
+    n = len(_pending_log)
+    data = b"".join(_pending_log[:n])
+    if _log_torn:
+        data = b"\n" + data  # отделяем от обрывка прошлой неудачной записи
+    try:
+        with open(XP_LOG_FILE, "ab") as f:
+            f.write(data)
+    except OSError:
+        _log_torn = True
+        raise
+    _log_torn = False
+    # Из очереди убираем только то, что реально записали
+    del _pending_log[:n]
+
+def snapshot_db() -> None:
+    global _log_dirty, _log_torn
+    if DB_CACHE is None or not (_log_dirty or _pending_log):
+        return
+    # Снапшот уже содержит всё из лога и очереди; лог обнуляем только после атомарного rename
+    save_db(DB_CACHE)
+    _pending_log.clear()
+    open(XP_LOG_FILE, "wb").close()
+    _log_dirty = False
+    _log_torn = False
+
+async def _flush_loop():
+    while True:
+        await _flush_event.wait()
+        await asyncio.sleep(FLUSH_DELAY)
+        async with db_lock:
+            _flush_event.clear()
+            try:
+                # Дозапись накопленных строк в XP_LOG_FILE — в потоке, чтобы не стопорить event loop
+                await asyncio.to_thread(flush_log)
+            except Exception as e:
+                print(f"DB flush error: {e}")
+
+async def _snapshot_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        async with db_lock:
+            try:
+                await asyncio.to_thread(snapshot_db)
+            except Exception as e:
+                print(f"DB snapshot error: {e}")
+
+atexit.register(snapshot_db)
+
 def guild_bucket(db: Dict[str, Any], guild_id: int) -> Dict[str, Any]:
     gid = str(guild_id)
     if gid not in db:
         db[gid] = {"members": {}}
     return db[gid]
 
-def ensure_member(db_guild: Dict[str, Any], user_id: int) -> Dict[str, Any]:
-    members = db_guild["members"]
-    uid = str(user_id)
-    if uid not in members:
-        members[uid] = {"xp": 0}
-    return members[uid]
-
 # -------------------- Логика XP --------------------
 def level_from_xp(xp_total: int) -> int:
-    lvl = 1
-    for i, threshold in enumerate(XP_THRESHOLDS, start=1):
-        if xp_total >= threshold:
-            lvl = i
-    return min(lvl, 20)
-
-def next_threshold(level: int) -> Optional[int]:
-    if level >= 20:
-        return None
-    return XP_THRESHOLDS[level]
-
-def prev_threshold(level: int) -> int:
-    return XP_THRESHOLDS[level - 1]
-
-def remaining_to_next(xp_total: int) -> Optional[int]:
-    lvl = level_from_xp(xp_total)
-    nxt = next_threshold(lvl)
-    if nxt is None:
-        return None
-    return max(0, nxt - xp_total)
+    # Число порогов <= xp_total и есть уровень (пороги отсортированы)
+    return max(1, bisect_right(XP_THRESHOLDS, xp_total))
 
-def progress_in_level(xp_total: int) -> Tuple[int, int, int]:
+def _derive(xp_total: int) -> Tuple[int, int, Optional[int], int, int, Optional[int]]:
+    """
+    Все производные от XP за один поиск уровня:
+    (уровень, нижний порог, верхний порог, XP в уровне, XP на уровень, осталось до следующего)
+    """
     lvl = level_from_xp(xp_total)
+    low = XP_THRESHOLDS[lvl - 1]
     if lvl >= 20:
-        return 0, 0, 20
-    low = prev_threshold(lvl)
-    high = next_threshold(lvl)
-    cur = xp_total - low
-    need = (high - low) if high is not None else 0
-    return max(0, cur), max(0, need), lvl
+        return lvl, low, None, 0, 0, None
+    high = XP_THRESHOLDS[lvl]
+    return lvl, low, high, max(0, xp_total - low), high - low, max(0, high - xp_total)
+
+def level_and_remaining(xp_total: int) -> Tuple[int, Optional[int]]:
+    lvl, _, _, _, _, rem = _derive(xp_total)
+    return lvl, rem
+
+# Любая полоска ширины PROGRESS_WIDTH — это срез длины PROGRESS_WIDTH из шаблона
+_BAR_TEMPLATE = "█" * PROGRESS_WIDTH + "░" * PROGRESS_WIDTH
 
 def render_progress_bar(cur: int, need: int, width: int = PROGRESS_WIDTH) -> str:
-    if need <= 0:
-        return "█" * width
-    filled = int(round(width * (cur / need)))
-    filled = max(0, min(width, filled))
+    # Целочисленное округление половины вверх, без float
+    filled = width if need <= 0 else max(0, min(width, (width * cur + need // 2) // need))
+    if width == PROGRESS_WIDTH:
+        return _BAR_TEMPLATE[PROGRESS_WIDTH - filled:2 * PROGRESS_WIDTH - filled]
     return ("█" * filled) + ("░" * (width - filled))
 
 def render_progress_abs(xp_total: int) -> Tuple[str, Optional[int]]:
@@ -117,11 +219,9 @@ def render_progress_abs(xp_total: int) -> Tuple[str, Optional[int]]:
     - "<low> → <xp_total> из <high> (<percent>%)"  для уровней 1–19
     - "MAX"                                        для 20 уровня
     """
-    cur, need, lvl = progress_in_level(xp_total)
+    lvl, low, high, cur, need, _ = _derive(xp_total)
     if lvl == 20:
         return "MAX", None
-    low = prev_threshold(lvl)
-    high = next_threshold(lvl)
     percent = int(cur / need * 100) if need else 100
     return f"{low} → {xp_total} из {high} ({percent}%)", percent
 
@@ -133,6 +233,14 @@ intents.members = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
 # -------------------- Утилиты оформления --------------------
+# URL иконки гильдии, сбрасывается в on_guild_update
+_GUILD_ICON_URL: Dict[int, Optional[str]] = {}
+
+def _icon_url(guild: discord.Guild) -> Optional[str]:
+    if guild.id not in _GUILD_ICON_URL:
+        _GUILD_ICON_URL[guild.id] = guild.icon.url if guild.icon else None
+    return _GUILD_ICON_URL[guild.id]
+
 def make_embed(
     title: str,
     description: Optional[str] = None,
@@ -146,27 +254,62 @@ def make_embed(
     if user is not None:
         embed.set_author(name=user.display_name, icon_url=user.display_avatar.url)
     if guild is not None:
-        embed.set_footer(text=guild.name, icon_url=guild.icon.url if guild.icon else discord.Embed.Empty)
+        embed.set_footer(text=guild.name, icon_url=_icon_url(guild))
     return embed
 
+# (guild_id, user_id) -> когда выяснили, что участника нет; чтобы не ходить в API за ушедшими повторно
+_MISSING_MEMBERS: Dict[Tuple[int, int], float] = {}
+
+def _known_missing(guild_id: int, uid: int) -> bool:
+    seen = _MISSING_MEMBERS.get((guild_id, uid))
+    if seen is None:
+        return False
+    if time.monotonic() - seen > MISSING_MEMBER_TTL:
+        del _MISSING_MEMBERS[(guild_id, uid)]
+        return False
+    return True
+
 async def _get_member_safe(guild: discord.Guild, uid: int) -> Optional[discord.Member]:
     m = guild.get_member(uid)
     if m is not None:
         return m
+    if _known_missing(guild.id, uid):
+        return None
     try:
         return await guild.fetch_member(uid)
     except discord.NotFound:
+        _MISSING_MEMBERS[(guild.id, uid)] = time.monotonic()
         return None
 
+async def _get_members_bulk(guild: discord.Guild, uids: List[int]) -> Dict[int, Optional[discord.Member]]:
+    # Промахи кэша добираем одним запросом через gateway (до 100 id за раз), а не fetch_member на каждого.
+    # Ушедших помечаем в _MISSING_MEMBERS и здесь, и в запасном пути через _get_member_safe (на NotFound)
+    resolved = {uid: guild.get_member(uid) for uid in uids}
+    missing = [uid for uid, m in resolved.items() if m is None and not _known_missing(guild.id, uid)]
+    chunks = [missing[start:start + 100] for start in range(0, len(missing), 100)]
+    batches = await asyncio.gather(
+        *[guild.query_members(user_ids=chunk, limit=100) for chunk in chunks],
+        return_exceptions=True
+    )
+    now = time.monotonic()
+    for chunk, fetched in zip(chunks, batches):
+        if isinstance(fetched, BaseException):
+            print(f"query_members error for guild {guild.id}: {fetched!r}, falling back to fetch_member")
+            fallback = await asyncio.gather(*[_get_member_safe(guild, uid) for uid in chunk])
+            resolved.update(zip(chunk, fallback))
+            continue
+        resolved.update({m.id: m for m in fetched})
+        for uid in chunk:
+            if resolved[uid] is None:
+                _MISSING_MEMBERS[(guild.id, uid)] = now
+    return resolved
+
 async def send_text_safely(interaction: discord.Interaction, text: str, ephemeral: bool = False):
-    chunks: List[str] = []
-    start = 0
-    while start < len(text):
-        chunks.append(text[start:start + MAX_MESSAGE_LEN])
-        start += MAX_MESSAGE_LEN
+    chunks = (text[start:start + MAX_MESSAGE_LEN] for start in range(0, len(text), MAX_MESSAGE_LEN))
     if not interaction.response.is_done():
-        await interaction.response.send_message(chunks[0], ephemeral=ephemeral)
-        chunks = chunks[1:]
+        first = next(chunks, None)
+        if first is not None:
+            await interaction.response.send_message(first, ephemeral=ephemeral)
     for ch in chunks:
         await interaction.followup.send(ch, ephemeral=ephemeral)
 
@@ -184,28 +327,79 @@ async def _copy_to_guild_and_sync(guild: discord.Guild | int):
     bot.tree.copy_global_to(guild=gobj)
     await bot.tree.sync(guild=gobj)
 
-async def _ensure_guild_has_all_commands(guild: discord.Guild):
-    # Форсим копирование и синк всегда, чтобы изменения параметров сразу появлялись
+def _commands_hash() -> str:
+    # Отпечаток всех команд вместе с параметрами: меняется при любой правке описаний/опций
+    payload = orjson.dumps([c.to_dict() for c in bot.tree.get_commands()], option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(payload).hexdigest()
+
+def load_synced_hashes() -> Dict[str, str]:
+    if not os.path.exists(COMMANDS_HASH_FILE):
+        return {}
+    try:
+        with open(COMMANDS_HASH_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+
+def save_synced_hashes(hashes: Dict[str, str]) -> None:
+    tmp = COMMANDS_HASH_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(hashes))
+    os.replace(tmp, COMMANDS_HASH_FILE)
+
+async def _ensure_guild_has_all_commands(guild: discord.Guild, cmd_hash: str, synced: Dict[str, str]):
+    # Синкаем только гильдии, где набор команд отличается от последнего синка
+    gid = str(guild.id)
+    if synced.get(gid) == cmd_hash:
+        return
     await _copy_to_guild_and_sync(guild)
+    synced[gid] = cmd_hash
 
 @bot.event
 async def on_ready():
+    global _flush_task, _snapshot_task
+    if _flush_task is None:
+        _flush_task = asyncio.create_task(_flush_loop())
+    if _snapshot_task is None:
+        _snapshot_task = asyncio.create_task(_snapshot_loop())
+    # Heroku гасит дино через SIGTERM: закрываем бота, bot.run возвращается и atexit делает снапшот
     try:
-        for guild in bot.guilds:
-            await _ensure_guild_has_all_commands(guild)
-        print("Slash copied & synced per-guild (forced)")
-    except Exception as e:
-        print(f"Slash ensure error: {e}")
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+    except NotImplementedError:
+        pass  # Windows
+    cmd_hash = _commands_hash()
+    synced = load_synced_hashes()
+    guilds = list(bot.guilds)
+    results = await asyncio.gather(
+        *[_ensure_guild_has_all_commands(guild, cmd_hash, synced) for guild in guilds],
+        return_exceptions=True
+    )
+    for guild, res in zip(guilds, results):
+        if isinstance(res, BaseException):
+            print(f"Slash ensure error for guild {guild.id}: {res}")
+    print("Slash copied & synced per-guild (changed only)")
+    save_synced_hashes(synced)
     print(f"Logged in as {bot.user} (ID: {bot.user.id})")
 
 @bot.event
 async def on_guild_join(guild: discord.Guild):
     try:
         await _copy_to_guild_and_sync(guild)
+        synced = load_synced_hashes()
+        synced[str(guild.id)] = _commands_hash()
+        save_synced_hashes(synced)
         print(f"Slash copied & synced for joined guild {guild.id}")
     except Exception as e:
         print(f"Slash sync on join error: {e}")
 
+@bot.event
+async def on_member_join(member: discord.Member):
+    _MISSING_MEMBERS.pop((member.guild.id, member.id), None)
+
+@bot.event
+async def on_guild_update(before: discord.Guild, after: discord.Guild):
+    _GUILD_ICON_URL.pop(after.id, None)
+
 # -------------------- Команды --------------------
 # helper: кто считается модератором для добавления других
 def _is_moderator_or_admin(member: discord.Member) -> bool:
@@ -252,9 +446,8 @@ async def join(
         uid = str(target.id)
 
         if uid in members:
-            xp_now = int(members[uid].get("xp", 0))
-            lvl = level_from_xp(xp_now)
-            rem = remaining_to_next(xp_now)
+            xp_now = int(members[uid])
+            lvl, rem = level_and_remaining(xp_now)
 
             eb = discord.Embed(
                 title=f"{target.display_name} уже в пати",
@@ -273,11 +466,10 @@ async def join(
         min_xp = XP_THRESHOLDS[level - 1]
         if xp < min_xp:
             xp = min_xp
-        members[uid] = {"xp": xp}
-        save_db(db)
+        members[uid] = xp
+        record_xp(interaction.guild_id, target.id, xp)
 
-    cur_level = level_from_xp(xp)
-    rem = remaining_to_next(xp)
+    cur_level, rem = level_and_remaining(xp)
 
     eb = discord.Embed(
         title=f"{target.display_name} вступил в пати!",
@@ -297,18 +489,17 @@ async def status(interaction: discord.Interaction, user: Optional[discord.Member
     user = user or interaction.user
     db = load_db()
     g = guild_bucket(db, interaction.guild_id)
-    m = g["members"].get(str(user.id))
+    xp = g["members"].get(str(user.id))
 
-    if not m:
+    if xp is None:
         await interaction.response.send_message(
             "Ты ещё не в пати. Используй /join." if user == interaction.user else f"{user.display_name} ещё не в пати.",
             ephemeral=True
         )
         return
 
-    xp = int(m.get("xp", 0))
-    _, _, lvl = progress_in_level(xp)
-    rem = remaining_to_next(xp)
+    xp = int(xp)
+    lvl, rem = level_and_remaining(xp)
 
     eb = discord.Embed(
         title=f"Статус {user.display_name}",
@@ -333,13 +524,15 @@ async def party(interaction: discord.Interaction):
         await interaction.response.send_message("Пати пока пустая. Используйте /join.", ephemeral=True)
         return
 
+    resolved = await _get_members_bulk(interaction.guild, [int(uid) for uid in members])
+
     sortable = []
-    for uid, data in members.items():
-        xp = int(data.get("xp", 0))
-        lvl = level_from_xp(xp)
-        member = await _get_member_safe(interaction.guild, int(uid))
+    for uid, xp in members.items():
+        xp = int(xp)
+        lvl, rem = level_and_remaining(xp)
+        member = resolved.get(int(uid))
         name = member.display_name if member else f"UID:{uid}"
-        sortable.append((-lvl, -xp, name.lower(), xp, lvl, name))
+        sortable.append((-lvl, -xp, name.lower(), xp, lvl, name, rem))
     sortable.sort()
 
     eb = make_embed(
@@ -348,8 +541,7 @@ async def party(interaction: discord.Interaction):
         guild=interaction.guild
     )
 
-    for idx, (_, __, ___, xp, lvl, name) in enumerate(sortable, start=1):
-        rem = remaining_to_next(xp)
+    for idx, (_, __, ___, xp, lvl, name, rem) in enumerate(sortable, start=1):
         val = f"Уровень {lvl} • {xp} XP"
         if rem is not None and lvl < 20:
             val += f"\nДо след.: {rem} XP"
@@ -363,26 +555,21 @@ async def party(interaction: discord.Interaction):
     await send_embed_safely(interaction, eb)
 
 # -------------------- XP операции --------------------
-async def add_xp_for_member(guild: discord.Guild, user: discord.Member, add: int) -> Dict[str, Any]:
-    async with db_lock:
-        db = load_db()
-        g = guild_bucket(db, guild.id)
-        m = ensure_member(g, user.id)
+def _apply_xp_locked(db_guild: Dict[str, Any], user_id: int, add: int) -> Dict[str, Any]:
+    # Вызывающий держит db_lock; меняет только уже загруженный бакет гильдии, диск не трогает
+    members = db_guild["members"]
+    uid = str(user_id)
 
-        before_xp = int(m.get("xp", 0))
-        before_lvl = level_from_xp(before_xp)
+    before_xp = int(members.get(uid, 0))
+    before_lvl = level_from_xp(before_xp)
 
-        m["xp"] = max(0, before_xp + add)
-        after_xp = int(m["xp"])
-        after_lvl = level_from_xp(after_xp)
-        save_db(db)
+    after_xp = max(0, before_xp + add)
+    members[uid] = after_xp
+    after_lvl, _, _, cur, need, rem = _derive(after_xp)
 
     leveled = after_lvl > before_lvl
-    rem = remaining_to_next(after_xp)
-    cur, need, _ = progress_in_level(after_xp)
 
     return {
-        "user": user,
         "add": add,
         "after_xp": after_xp,
         "after_lvl": after_lvl,
@@ -392,6 +579,16 @@ async def add_xp_for_member(guild: discord.Guild, user: discord.Member, add: int
         "need_for_level": need,
     }
 
+async def add_xp_for_member(guild: discord.Guild, user: discord.Member, add: int) -> Dict[str, Any]:
+    async with db_lock:
+        db = load_db()
+        g = guild_bucket(db, guild.id)
+        info = _apply_xp_locked(g, user.id, add)
+        record_xp(guild.id, user.id, info["after_xp"])
+
+    info["user"] = user
+    return info
+
 def build_addxp_embed(interaction: discord.Interaction, info: Dict[str, Any], reason: Optional[str]) -> discord.Embed:
     user = info["user"]
     add = info["add"]
@@ -422,7 +619,7 @@ def build_addxp_embed(interaction: discord.Interaction, info: Dict[str, Any], re
 
     if leveled:
         eb.set_footer(text=f"{interaction.guild.name} • Уровень повышен!",
-                      icon_url=interaction.guild.icon.url if interaction.guild.icon else discord.Embed.Empty)
+                      icon_url=_icon_url(interaction.guild))
     return eb
 
 @bot.tree.command(name="addxp", description="Добавить XP игроку и показать прогресс.")
@@ -487,12 +684,18 @@ async def addxp_all(
         guild=interaction.guild
     )
 
-    for uid in member_ids:
-        member = await _get_member_safe(interaction.guild, int(uid))
-        if member is None:
-            continue
-        info = await add_xp_for_member(interaction.guild, member, amount)
+    by_id = await _get_members_bulk(interaction.guild, [int(uid) for uid in member_ids])
+    resolved = [m for m in by_id.values() if m is not None]
+
+    # Одна блокировка и одна дозапись в лог на всю пачку
+    async with db_lock:
+        db = load_db()
+        g = guild_bucket(db, interaction.guild_id)
+        infos = [_apply_xp_locked(g, member.id, amount) for member in resolved]
+        for member, info in zip(resolved, infos):
+            record_xp(interaction.guild_id, member.id, info["after_xp"])
 
+    for member, info in zip(resolved, infos):
         if info["leveled"]:
             leveled_up.append(member.mention)
 
@@ -533,13 +736,11 @@ async def setlevel(
     async with db_lock:
         db = load_db()
         g = guild_bucket(db, interaction.guild_id)
-        m = ensure_member(g, user.id)
-        m["xp"] = XP_THRESHOLDS[level - 1]
-        save_db(db)
+        xp = XP_THRESHOLDS[level - 1]
+        g["members"][str(user.id)] = xp
+        record_xp(interaction.guild_id, user.id, xp)
 
-    xp = int(m["xp"])
-    cur, need, lvl = progress_in_level(xp)
-    rem = remaining_to_next(xp)
+    lvl, _, _, cur, need, rem = _derive(xp)
 
     eb = make_embed(f"Установлен уровень для {user.display_name}", color=COLOR_WARN, user=user, guild=interaction.guild)
     eb.add_field(name="Уровень", value=str(level), inline=True)
@@ -556,14 +757,13 @@ async def setlevel(
 
 @bot.tree.command(name="xptable", description="Пороговые значения XP для уровней 1–20.")
 async def xptable(interaction: discord.Interaction):
-    lines = ["Пороги XP (кумулятивно):"]
-    for i, threshold in enumerate(XP_THRESHOLDS, start=1):
-        lines.append(f"{i:>2}: {threshold}")
-    eb = make_embed("Таблица XP 1–20", "```\n" + "\n".join(lines) + "\n```", color=COLOR_INFO, guild=interaction.guild)
+    eb = make_embed("Таблица XP 1–20", XPTABLE_TEXT, color=COLOR_INFO, guild=interaction.guild)
     await send_embed_safely(interaction, eb)
 
 # ------------ Старт ------------
 token = os.getenv("DISCORD_TOKEN")
 if not token:
     raise RuntimeError("Положи токен бота в переменную окружения DISCORD_TOKEN")
+# БД грузим до старта, чтобы ни одна команда не застала DB_CACHE = None
+load_db()
 bot.run(token)